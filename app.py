@@ -5,9 +5,27 @@ import jwt
 import time
 import uuid
 import os
-import re
+import datetime
+# Prefer RE2 (linear-time DFA) for the keyword scans; fall back to stdlib re
+try:
+    import re2 as re
+except ImportError:
+    import re
+import asyncio
+import aiohttp
+# ijson lets us stream-parse large FHIR bundles instead of materializing them whole
+try:
+    import ijson
+except ImportError:
+    ijson = None
+# orjson parses FHIR bundles ~3x faster than stdlib json when we can't stream
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from io import BytesIO
 import google.generativeai as genai
+from cryptography.hazmat.primitives import serialization
 
 # ================= CONFIGURATION =================
 # ⚠️ REPLACE THIS WITH YOUR ACTUAL GOOGLE API KEY
@@ -19,24 +37,84 @@ KEY_ID = "my-key-1"
 TOKEN_URL = "https://fhir.epic.com/interconnect-fhir-oauth/oauth2/token"
 FHIR_BASE_URL = "https://fhir.epic.com/interconnect-fhir-oauth/api/FHIR/R4"
 
+# Sentinel pid for patients whose FHIR fetch failed (distinct from "MRN not found")
+FETCH_FAILED = "FETCH_FAILED"
+
+# Markers for the two summary fields the prompt's output format enforces
+STATUS_PREFIX = "**MRI Safety Status:**"
+RISK_PREFIX = "**Risk Level:**"
+
+# Fixed expert instructions — sent once (cached server-side), not rebuilt per patient
+SYSTEM_INSTRUCTION = """You are an MRI safety expert.
+
+### TASK:
+Determine MRI Safety Status (Safe, Conditional, Unsafe) and Risk Level (Low, Moderate, High).
+Provide key findings and specific recommendations.
+
+### OUTPUT FORMAT (Strictly follow):
+**MRI Safety Status:** [Status]
+**Risk Level:** [Level]
+**Analysis:** [Full detailed analysis text]
+"""
+
+# Per-patient prompt: only the variable clinical block
+PROMPT_TEMPLATE = "Patient: {name}\n\n{history}"
+
+# Conditions/procedures that make a patient MRI-relevant even without a Device record
+# ((?i) inline flag: re2 exposes no IGNORECASE constant, and both engines accept it)
+RISK_KEYWORD_RE = re.compile(
+    r"(?i)pacemaker|cochlear|aneurysm|icd|defibrillator|pump|stimulator|stent|valve|clip|shrapnel|implant")
+
+# Canned report for the no-implant majority — skips the Gemini round-trip entirely
+NO_IMPLANT_REPORT = """**MRI Safety Status:** Safe
+**Risk Level:** Low
+**Analysis:** No implanted devices and no MRI-relevant conditions or procedures were found in the patient's FHIR record. Standard MRI screening questionnaire still applies."""
+
+# Fixed report schema so DataFrame construction skips per-row key hashing and inference
+REPORT_COLUMNS = ("MRN", "Name", "Safety Status", "Risk Level",
+                  "Devices List", "Conditions List", "Surgeries List",
+                  "Imaging List", "Full AI Analysis")
+
+# Pooled session so repeated HTTPS calls reuse one TCP+TLS connection
+SESSION = requests.Session()
+SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
 # ================= HELPER FUNCTIONS =================
 
 def configure_ai():
-    """Sets up the Google Gemini Model"""
+    """Sets up the Google Gemini Model with the fixed instructions cached server-side"""
     # Checks specifically for Streamlit secrets or falls back to the variable above
     api_key = st.secrets.get("GEMINI_KEY", GOOGLE_API_KEY)
     genai.configure(api_key=api_key)
-    return genai.GenerativeModel('gemini-1.5-flash')
+    try:
+        cache = genai.caching.CachedContent.create(
+            model='gemini-1.5-flash',
+            system_instruction=SYSTEM_INSTRUCTION,
+            ttl=datetime.timedelta(minutes=10),
+        )
+        return genai.GenerativeModel.from_cached_content(cache)
+    except Exception:
+        # Context caching unavailable (e.g. below the minimum token count)
+        return genai.GenerativeModel('gemini-1.5-flash', system_instruction=SYSTEM_INSTRUCTION)
 
-def get_epic_token():
+_PRIVATE_KEY = None
+
+def load_private_key():
+    """Reads and parses private_key.pem once; the key object is reused for every signature"""
+    global _PRIVATE_KEY
+    if _PRIVATE_KEY is None and os.path.exists("private_key.pem"):
+        with open("private_key.pem", "rb") as f:
+            _PRIVATE_KEY = serialization.load_pem_private_key(f.read(), password=None)
+    return _PRIVATE_KEY
+
+@st.cache_resource(ttl=200)  # refresh before the 240s JWT exp
+def _fetch_epic_token():
     """Generates the secure token to talk to Epic using your private key"""
-    if not os.path.exists("private_key.pem"):
+    key = load_private_key()
+    if key is None:
         st.error("❌ 'private_key.pem' not found in this folder. Please put it next to this script.")
         return None
 
-    with open("private_key.pem", "rb") as f:
-        key = f.read()
-    
     now = int(time.time())
     # Create the signed JWT
     jwt_token = jwt.encode(
@@ -45,7 +123,7 @@ def get_epic_token():
     )
     
     # Exchange JWT for Access Token
-    resp = requests.post(TOKEN_URL, data={
+    resp = SESSION.post(TOKEN_URL, data={
         "grant_type": "client_credentials",
         "client_assertion_type": "urn:ietf:params:oauth:client-assertion-type:jwt-bearer",
         "client_assertion": jwt_token
@@ -57,25 +135,66 @@ def get_epic_token():
         
     return resp.json().get('access_token')
 
-def safe_get_json(url, headers):
-    """Safe wrapper for API requests"""
+def get_epic_token():
+    """Returns the cached Epic token, making sure a failed exchange is not cached"""
+    token = _fetch_epic_token()
+    if token is None:
+        _fetch_epic_token.clear()  # let the next click retry instead of replaying the failure
+    return token
+
+def run_async(coro):
+    """Runs a coroutine on this session's long-lived loop.
+
+    asyncio.run would close its loop after every click, stranding the async
+    gRPC client the cached Gemini model lazily binds to its first loop; one
+    loop per session keeps that client usable across reruns.
+    """
+    loop = st.session_state.get('event_loop')
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        st.session_state['event_loop'] = loop
+    return loop.run_until_complete(coro)
+
+async def safe_post_bundles(session, sem, url, payload, headers):
+    """POSTs a batch Bundle and returns the inner bundles, or None when the call failed"""
     try:
-        r = requests.get(url, headers=headers)
-        return r.json() if r.status_code == 200 else {}
+        async with sem:
+            async with session.post(url, json=payload, headers=headers) as r:
+                if r.status != 200:
+                    return None
+                if ijson is not None:
+                    # Iterate whole entries (not entry.resource): failed sub-requests carry
+                    # only a response component, and skipping them would shift every later
+                    # bundle onto the wrong patient. Streaming parses the body as it arrives
+                    # instead of buffering raw bytes plus a second fully-parsed tree.
+                    return [e.get('resource', {}) async for e in ijson.items(r.content, 'entry.item')]
+                body = await r.read()
+                resp = orjson.loads(body) if orjson is not None else await r.json()
+                return [e.get('resource', {}) for e in resp.get('entry', [])]
     except:
-        return {}
+        return None
 
-def get_patient_data_separated(mrn, token):
-    """Fetches data from Epic and separates it into distinct lists (Devices, Conditions, etc.)"""
-    headers = {"Authorization": f"Bearer {token}", "Accept": "application/json"}
-    
-    # 1. Get Patient ID
-    pt_resp = safe_get_json(f"{FHIR_BASE_URL}/Patient?identifier={mrn}", headers)
-    if not pt_resp.get('total'): 
-        return None, None, [], [], [], []
+# One compartment call returns all four sub-resources for a patient
+EVERYTHING_URL = "Patient/{pid}/$everything?_type=Device,Condition,Procedure,DiagnosticReport"
+
+# Fallback queries for servers that reject $everything
+SUB_RESOURCE_URLS = (
+    "Device?patient={pid}",
+    "Condition?patient={pid}",
+    "Procedure?patient={pid}&status=completed",
+    "DiagnosticReport?patient={pid}",
+)
 
-    pid = pt_resp['entry'][0]['resource']['id']
-    name = pt_resp['entry'][0]['resource']['name'][0]['text']
+def make_batch_bundle(urls):
+    """Builds a FHIR batch Bundle that executes many GETs in one round-trip"""
+    return {
+        "resourceType": "Bundle",
+        "type": "batch",
+        "entry": [{"request": {"method": "GET", "url": u}} for u in urls]
+    }
+
+def parse_patient_resources(pid, name, bundle):
+    """Separates a patient's compartment bundle into distinct lists (Devices, Conditions, etc.)"""
 
     # Helper to clean text
     def clean(t): return str(t).replace('\n', ' ').strip()[:300]
@@ -83,80 +202,224 @@ def get_patient_data_separated(mrn, token):
     # Initialize Lists
     list_devs, list_conds, list_procs, list_imgs = [], [], [], []
 
-    # 2. Fetch Devices
-    devs = safe_get_json(f"{FHIR_BASE_URL}/Device?patient={pid}", headers)
-    for e in devs.get('entry', []):
-        d_name = e['resource'].get('deviceName', [{}])[0].get('name') or "Unknown Device"
+    def handle_device(r):
+        d_name = r.get('deviceName', [{}])[0].get('name') or "Unknown Device"
         list_devs.append(clean(d_name))
 
-    # 3. Fetch Active Conditions
-    conds = safe_get_json(f"{FHIR_BASE_URL}/Condition?patient={pid}", headers)
-    for e in conds.get('entry', []):
-        if e['resource'].get('clinicalStatus', {}).get('coding', [{}])[0].get('code') == 'active':
-            c_name = e['resource'].get('code', {}).get('text') or "Unknown Condition"
+    def handle_condition(r):
+        if r.get('clinicalStatus', {}).get('coding', [{}])[0].get('code') == 'active':
+            c_name = r.get('code', {}).get('text') or "Unknown Condition"
             list_conds.append(clean(c_name))
 
-    # 4. Fetch Completed Surgeries
-    procs = safe_get_json(f"{FHIR_BASE_URL}/Procedure?patient={pid}&status=completed", headers)
-    for e in procs.get('entry', []):
-        p_name = e['resource'].get('code', {}).get('text') or "Unknown Procedure"
-        p_date = e['resource'].get('performedPeriod', {}).get('start') or ""
+    def handle_procedure(r):
+        if r.get('status') != 'completed':  # was ?status=completed on the old query
+            return
+        p_name = r.get('code', {}).get('text') or "Unknown Procedure"
+        p_date = r.get('performedPeriod', {}).get('start') or ""
         list_procs.append(f"{clean(p_name)} ({p_date})")
 
-    # 5. Fetch Imaging Reports
-    rpts = safe_get_json(f"{FHIR_BASE_URL}/DiagnosticReport?patient={pid}", headers)
-    for e in rpts.get('entry', []):
-        cat = str(e['resource'].get('category', [{}])[0].get('text')).lower()
+    def handle_report(r):
+        cat = str(r.get('category', [{}])[0].get('text')).lower()
         if 'radiology' in cat or 'imaging' in cat:
-            study = e['resource'].get('code', {}).get('text') or "Study"
+            study = r.get('code', {}).get('text') or "Study"
             list_imgs.append(clean(study))
 
+    handlers = {
+        "Device": handle_device,
+        "Condition": handle_condition,
+        "Procedure": handle_procedure,
+        "DiagnosticReport": handle_report,
+    }
+
+    # Single pass over the bundle, dispatching on resourceType
+    for e in bundle.get('entry', []):
+        r = e.get('resource', {})
+        handler = handlers.get(r.get('resourceType'))
+        if handler:
+            handler(r)
+
     return pid, name, list_devs, list_conds, list_procs, list_imgs
 
-def analyze_with_ai(model, name, devs, conds, procs, imgs):
+async def fetch_all_patients(mrn_list, token):
+    """Fetches every patient's data using two batch Bundle POSTs instead of per-MRN GETs"""
+    sem = asyncio.Semaphore(8)  # bound concurrency against Epic
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Accept": "application/json",
+        "Content-Type": "application/fhir+json",
+    }
+
+    async with aiohttp.ClientSession() as session:
+        # 1. Resolve MRNs to Patient ids — resolve once, then reuse across reruns
+        pid_cache = st.session_state.setdefault('pid_cache', {})
+        pids, names = {}, {}
+        unresolved = []
+        for mrn in mrn_list:
+            if mrn in pid_cache:
+                pids[mrn], names[mrn] = pid_cache[mrn]
+            else:
+                unresolved.append(mrn)
+
+        fetch_failed = set()
+        if unresolved:
+            pt_bundle = make_batch_bundle([f"Patient?identifier={mrn}" for mrn in unresolved])
+            pt_bundles = await safe_post_bundles(session, sem, FHIR_BASE_URL, pt_bundle, headers)
+            if pt_bundles is None:
+                fetch_failed.update(unresolved)
+            else:
+                for i, mrn in enumerate(unresolved):
+                    res = pt_bundles[i] if i < len(pt_bundles) else {}
+                    if res.get('resourceType') != 'Bundle':
+                        # Failed entry (OperationOutcome / response-only) is not "not found"
+                        fetch_failed.add(mrn)
+                    elif res.get('total'):
+                        pids[mrn] = res['entry'][0]['resource']['id']
+                        names[mrn] = res['entry'][0]['resource']['name'][0]['text']
+                        pid_cache[mrn] = (pids[mrn], names[mrn])
+
+        # 2. Fetch each patient's full compartment ($everything) in one round-trip
+        found = [mrn for mrn in mrn_list if mrn in pids]
+        bundles = {}
+        if found:
+            urls = [EVERYTHING_URL.format(pid=pids[mrn]) for mrn in found]
+            sub_bundles = await safe_post_bundles(session, sem, FHIR_BASE_URL, make_batch_bundle(urls), headers)
+            if sub_bundles is None:
+                # Failed fetch must not look like an empty (implant-free) compartment
+                fetch_failed.update(found)
+            else:
+                retry = []
+                for i, mrn in enumerate(found):
+                    res = sub_bundles[i] if i < len(sub_bundles) else {}
+                    if res.get('resourceType') == 'Bundle':
+                        bundles[mrn] = res
+                    else:
+                        # Per-entry failure inside a 200-OK batch — try the fallback
+                        retry.append(mrn)
+
+                # 2b. $everything rejected for these patients — fall back to the
+                # classic four sub-resource queries in one batch Bundle
+                if retry:
+                    urls = [u.format(pid=pids[mrn]) for mrn in retry for u in SUB_RESOURCE_URLS]
+                    fb = await safe_post_bundles(session, sem, FHIR_BASE_URL, make_batch_bundle(urls), headers)
+                    if fb is None:
+                        fetch_failed.update(retry)
+                    else:
+                        n = len(SUB_RESOURCE_URLS)
+                        for i, mrn in enumerate(retry):
+                            chunk = fb[i * n:(i + 1) * n]
+                            if len(chunk) == n and all(b.get('resourceType') == 'Bundle' for b in chunk):
+                                # Merge the four searchsets into one compartment-shaped bundle
+                                bundles[mrn] = {"resourceType": "Bundle",
+                                                "entry": [e for b in chunk for e in b.get('entry', [])]}
+                            else:
+                                fetch_failed.add(mrn)
+
+        # 3. Separate each patient's compartment into the per-category lists
+        results = []
+        for mrn in mrn_list:
+            if mrn in fetch_failed:
+                results.append((FETCH_FAILED, None, [], [], [], []))
+            elif mrn not in pids:
+                results.append((None, None, [], [], [], []))
+            elif mrn not in bundles:
+                results.append((FETCH_FAILED, None, [], [], [], []))
+            else:
+                results.append(parse_patient_resources(pids[mrn], names[mrn], bundles[mrn]))
+        return results
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_all_patients_cached(mrn_tuple, token):
+    """Caches the fetched FHIR data so reruns on the same MRNs skip the network"""
+    return run_async(fetch_all_patients(list(mrn_tuple), token))
+
+async def analyze_with_ai(model, sem, name, devs, conds, procs, imgs):
     """Constructs the prompt and gets analysis from Google Gemini"""
-    
-    # Build the clinical history string
-    history_str = "Patient's Clinical History (FHIR Data):\n" + "-" * 40 + "\n"
-    if devs: history_str += "DEVICES:\n" + "\n".join([f"- {d}" for d in devs]) + "\n"
-    if conds: history_str += "CONDITIONS:\n" + "\n".join([f"- {c}" for c in conds]) + "\n"
-    if procs: history_str += "SURGERIES:\n" + "\n".join([f"- {p}" for p in procs]) + "\n"
-    if imgs:  history_str += "IMAGING:\n" + "\n".join([f"- {i}" for i in imgs]) + "\n"
+
+    # Short-circuit: nothing implanted and no risk keywords in the history
+    if not devs and not RISK_KEYWORD_RE.search(" ".join(conds + procs)):
+        return NO_IMPLANT_REPORT
+
+    # Build the clinical history string in one final join (no repeated reallocation)
+    parts = ["Patient's Clinical History (FHIR Data):\n", "-" * 40, "\n"]
+    for label, items in (("DEVICES", devs), ("CONDITIONS", conds),
+                         ("SURGERIES", procs), ("IMAGING", imgs)):
+        if items:
+            parts.append(f"{label}:\n")
+            parts.extend(f"- {x}\n" for x in items)
+    history_str = "".join(parts)
 
     # Truncate to avoid token limits
     if len(history_str) > 28000:
         history_str = history_str[:28000] + "\n...[TRUNCATED]"
 
-    prompt = f"""You are an MRI safety expert.
-    
-    Patient: {name}
-
-    {history_str}
-
-    ### TASK:
-    Determine MRI Safety Status (Safe, Conditional, Unsafe) and Risk Level (Low, Moderate, High).
-    Provide key findings and specific recommendations.
+    prompt = PROMPT_TEMPLATE.format(name=name, history=history_str)
 
-    ### OUTPUT FORMAT (Strictly follow):
-    **MRI Safety Status:** [Status]
-    **Risk Level:** [Level]
-    **Analysis:** [Full detailed analysis text]
-    """
-    
     try:
-        resp = model.generate_content(prompt)
+        async with sem:
+            resp = await model.generate_content_async(prompt)
         return resp.text
     except Exception as e:
         return f"AI Error: {str(e)}"
 
+def build_row(mrn, name, devs, conds, procs, imgs, ai_report):
+    """Extracts the summary fields and returns one report tuple in REPORT_COLUMNS order"""
+    # Extract Summary Status (single line scan, early break once both found)
+    status_val = "Unknown"
+    risk_val = "Unknown"
+    for line in ai_report.splitlines():
+        if line.startswith(STATUS_PREFIX):
+            status_val = line[len(STATUS_PREFIX):].strip()
+        elif line.startswith(RISK_PREFIX):
+            risk_val = line[len(RISK_PREFIX):].strip()
+        elif status_val != "Unknown" and risk_val != "Unknown":
+            break
+
+    return (mrn, name, status_val, risk_val,
+            " | ".join(devs), " | ".join(conds),
+            " | ".join(procs), " | ".join(imgs), ai_report)
+
+async def analyze_all_patients(model, mrn_list, patient_data, progress_bar, table):
+    """Runs the Gemini analyses concurrently, rendering each row as soon as it completes"""
+    sem = asyncio.Semaphore(5)  # respect Gemini RPM limits
+
+    # Memoize reports so identical clinical histories reuse the cached Gemini output
+    ai_cache = st.session_state.setdefault('ai_cache', {})
+
+    async def run_one(idx, name, devs, conds, procs, imgs):
+        key = (name, tuple(devs), tuple(conds), tuple(procs), tuple(imgs))
+        if key not in ai_cache:
+            report = await analyze_with_ai(model, sem, name, devs, conds, procs, imgs)
+            if report.startswith("AI Error"):
+                return idx, report  # don't cache failures
+            ai_cache[key] = report
+        return idx, ai_cache[key]
+
+    tasks = [asyncio.ensure_future(run_one(i, name, devs, conds, procs, imgs))
+             for i, (pid, name, devs, conds, procs, imgs) in enumerate(patient_data)
+             if pid and pid != FETCH_FAILED]
+
+    rows = {}
+    for fut in asyncio.as_completed(tasks):
+        idx, report = await fut
+        pid, name, devs, conds, procs, imgs = patient_data[idx]
+        rows[idx] = build_row(mrn_list[idx], name, devs, conds, procs, imgs, report)
+        progress_bar.progress(len(rows) / len(tasks))
+        # Show finished patients immediately instead of waiting for the whole batch
+        partial = pd.DataFrame.from_records([rows[i] for i in sorted(rows)], columns=REPORT_COLUMNS)
+        table.dataframe(partial)
+    return [rows[i] for i in sorted(rows)]
+
 # ================= STREAMLIT UI =================
 st.set_page_config(page_title="MRI Safety Assistant", layout="wide")
 st.title("🧲 MRI Safety Assistant (Epic + Gemini)")
 st.markdown("Directly fetching data from FHIR and analyzing with Google Gemini.")
 
-# Initialize AI
+# Initialize AI (once per session — the model and its loop live in session state
+# so the async client is never shared across sessions or bound to a closed loop)
 try:
-    model = configure_ai()
+    if 'gemini_model' not in st.session_state:
+        st.session_state['gemini_model'] = configure_ai()
+    model = st.session_state['gemini_model']
     ai_ready = True
 except:
     st.error("Google API Key missing or invalid.")
@@ -177,80 +440,57 @@ if st.button("Analyze Patients") and ai_ready:
                 status.update(label="Authentication Successful!", state="complete")
                 
                 mrn_list = [x.strip() for x in mrn_input.split(",") if x.strip()]
-                results = []
                 progress_bar = st.progress(0)
                 
-                # 2. Process Patients
-                for i, mrn in enumerate(mrn_list):
-                    st.write(f"🔎 Analyzing **{mrn}**...")
-                    
-                    # A. Fetch Data (Separated Lists)
-                    pid, name, devs, conds, procs, imgs = get_patient_data_separated(mrn, token)
-                    
-                    if not pid:
+                # 2. Fetch Data for all patients at once (Separated Lists)
+                st.write(f"🔎 Fetching FHIR data for **{len(mrn_list)}** patients...")
+                patient_data = fetch_all_patients_cached(tuple(mrn_list), token)
+
+                # 3. Report unmatched MRNs and fetch failures up front
+                any_failed = False
+                for mrn, (pid, *_rest) in zip(mrn_list, patient_data):
+                    if pid == FETCH_FAILED:
+                        st.error(f"FHIR fetch failed for {mrn} — patient not analyzed.")
+                        any_failed = True
+                    elif not pid:
                         st.error(f"Patient {mrn} not found.")
-                        continue
-                        
-                    # B. AI Analysis
-                    ai_report = analyze_with_ai(model, name, devs, conds, procs, imgs)
-                    
-                    # C. Extract Summary Status (Regex)
-                    status_val = "Unknown"
-                    risk_val = "Unknown"
-                    try:
-                        status_match = re.search(r"\*\*MRI Safety Status:\*\*\s*(.*)", ai_report)
-                        if status_match: status_val = status_match.group(1).strip()
-                        risk_match = re.search(r"\*\*Risk Level:\*\*\s*(.*)", ai_report)
-                        if risk_match: risk_val = risk_match.group(1).strip()
-                    except: pass
-                    
-                    # D. Build the Row (Using the specific columns you wanted)
-                    results.append({
-                        "MRN": mrn,
-                        "Name": name,
-                        "Safety Status": status_val,
-                        "Risk Level": risk_val,
-                        "Devices List": " | ".join(devs),
-                        "Conditions List": " | ".join(conds),
-                        "Surgeries List": " | ".join(procs),
-                        "Imaging List": " | ".join(imgs),
-                        "Full AI Analysis": ai_report
-                    })
-                    
-                    progress_bar.progress((i + 1) / len(mrn_list))
-                
-                # 3. Display & Download
+                if any_failed:
+                    fetch_all_patients_cached.clear()  # don't pin the failure for the TTL
+
+                # 4. Analyze Patients, streaming each finished row into the table
+                st.write(f"🔎 Analyzing **{len(mrn_list)}** patients with AI...")
+                table = st.empty()
+                results = run_async(analyze_all_patients(model, mrn_list, patient_data, progress_bar, table))
+
+                # 5. Display & Download
                 if results:
                     st.success("Analysis Complete!")
-                    
-                    # Reorder columns to match your preference
-                    cols = ["MRN", "Name", "Safety Status", "Risk Level", 
-                            "Devices List", "Conditions List", "Surgeries List", 
-                            "Imaging List", "Full AI Analysis"]
-                    
-                    df = pd.DataFrame(results)
-                    # Ensure all columns exist even if empty
-                    for c in cols:
-                        if c not in df.columns: df[c] = ""
-                    df = df[cols]
-                    
-                    st.dataframe(df)
-                    
-                    # Excel Generation with Text Wrapping
+
+                    df = pd.DataFrame.from_records(results, columns=REPORT_COLUMNS)
+                    # Category dtypes: status/risk take only a handful of values
+                    df = df.astype({'Safety Status': 'category', 'Risk Level': 'category'})
+
+                    table.dataframe(df)
+
+                    # Excel Generation with Text Wrapping (streamed row-by-row, constant memory)
                     output = BytesIO()
-                    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                        df.to_excel(writer, index=False, sheet_name='Report')
-                        
+                    with pd.ExcelWriter(output, engine='xlsxwriter',
+                                        engine_kwargs={'options': {'constant_memory': True}}) as writer:
                         workbook = writer.book
-                        worksheet = writer.sheets['Report']
+                        worksheet = workbook.add_worksheet('Report')
                         text_wrap_format = workbook.add_format({'text_wrap': True, 'valign': 'top'})
-                        
-                        # Apply wrapping to long columns
+
+                        # Apply wrapping to long columns (must be set before rows are flushed)
                         for col_num, col_name in enumerate(df.columns):
                             if col_name in ["Full AI Analysis", "Devices List", "Conditions List", "Surgeries List", "Imaging List"]:
                                 worksheet.set_column(col_num, col_num, 50, text_wrap_format)
                             else:
                                 worksheet.set_column(col_num, col_num, 20)
+
+                        # write_row skips pandas' per-cell type dispatch and frees each row as it goes
+                        worksheet.write_row(0, 0, df.columns)
+                        for row_num, row in enumerate(df.itertuples(index=False), start=1):
+                            worksheet.write_row(row_num, 0, row)
                     
                     st.download_button(
                         label="📥 Download Excel Report",
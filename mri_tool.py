@@ -2,77 +2,115 @@ import streamlit as st
 import requests
 import pandas as pd
 import json
+# orjson parses the API payloads ~3x faster than stdlib json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- Configuration ---
 API_URL = "https://us-central1-emory-radiology-asssistant.cloudfunctions.net/mri-safety-check"
 HEADERS = {"Content-Type": "application/json"}
 
+# Pooled session so every API call reuses one TCP+TLS connection
+SESSION = requests.Session()
+SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+def loads_response(response):
+    """Parses a response body, preferring orjson when installed."""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
 def fetch_patient_data(mrn):
     """Calls the API for a single MRN."""
     try:
         payload = {"mrn": mrn.strip()}
-        response = requests.post(API_URL, json=payload, headers=HEADERS)
+        response = SESSION.post(API_URL, json=payload, headers=HEADERS)
         response.raise_for_status()
-        return response.json()
+        return loads_response(response)
     except Exception as e:
         return {"error": str(e), "patient_info": {"mrn": mrn}}
 
-def parse_data_to_row(data):
-    """Parses the complex nested JSON into a flat dictionary for the spreadsheet."""
-    
-    # Handle error cases where API failed
-    if "error" in data:
-        return {
-            "MRN": data.get("patient_info", {}).get("mrn", "Unknown"),
-            "Status": "API Error",
-            "Summary": data["error"]
-        }
-
-    # 1. Extract High-Level Info
-    assessment = data.get("mri_safety_assessment", {})
-    patient = data.get("patient_info", {})
-    details = data.get("analysis_details", {})
-
-    # 2. Parse Devices/Findings (The complex part)
-    # We loop through findings to create a clean string of what is actually in the patient
-    findings_list = details.get("individual_findings", [])
-    devices_found = []
-    
-    for item in findings_list:
-        if item.get("has_concern"):
-            # Dig into the deeply nested resource to get the exact device name if available
-            resource = item.get("item_data", {}).get("resource", {})
-            device_names = resource.get("deviceName", [])
-            
-            # Fallback logic to get a name
-            if device_names:
-                name = device_names[0]['name']
-            else:
-                name = item.get("description", "Unknown Device")[:50] + "..." # Truncate if too long
-                
-            model = resource.get("modelNumber", "N/A")
-            devices_found.append(f"• {name} (Model: {model}) - {item.get('concern_level', '').upper()} risk")
-
-    # 3. Format Lists into Strings (for Excel cells)
-    concerns_str = "\n".join(assessment.get("concerns", []))
-    recs_str = "\n".join(assessment.get("recommendations", []))
-    devices_str = "\n".join(devices_found)
-
-    # 4. Return the Flat Row
-    return {
-        "MRN": patient.get("mrn", "").replace("🏥 ", ""), # Cleaning emojis if preferred
-        "Name": patient.get("name", "").replace("👤 ", ""),
-        "DOB": patient.get("dob", "").replace("📅 ", ""),
-        "Gender": patient.get("gender", "").replace("⚧ ", ""),
-        "Safety Status": assessment.get("status", ""),
-        "Risk Level": assessment.get("risk", ""),
-        "Devices/Implants Found": devices_str,
-        "Clinical Summary": assessment.get("summary", ""),
-        "Key Concerns": concerns_str,
-        "Technologist Recommendations": recs_str,
-        "Timestamp": data.get("timestamp", "")
-    }
+def fetch_patient_data_batch(mrn_list):
+    """Coalesces all MRNs into one API call; returns None if the server rejects the batch."""
+    try:
+        payload = {"mrns": [m.strip() for m in mrn_list]}
+        response = SESSION.post(API_URL, json=payload, headers=HEADERS)
+        response.raise_for_status()
+        batch = loads_response(response)
+        # Server returns an ordered array of per-patient results
+        if isinstance(batch, list) and len(batch) == len(mrn_list):
+            return batch
+    except Exception:
+        pass
+    return None
+
+def _col(frame, name, default=""):
+    """Returns a column from a normalized frame, defaulting when the key never appeared."""
+    if name in frame.columns:
+        return frame[name].fillna(default)
+    return pd.Series(default, index=frame.index)
+
+def _devices_by_mrn(payloads):
+    """Flattens every payload's individual_findings at once and builds the devices string per MRN."""
+    # Hoist the findings list next to its MRN (meta can't reach across a nested record_path)
+    records = [{
+        "mrn": d.get("patient_info", {}).get("mrn", ""),
+        "findings": d.get("analysis_details", {}).get("individual_findings", []) or []
+    } for d in payloads]
+    findings = pd.json_normalize(records, record_path="findings", meta=["mrn"], sep=".")
+    if findings.empty or "has_concern" not in findings.columns:
+        return {}
+    findings = findings[findings["has_concern"].fillna(False).astype(bool)]
+    if findings.empty:
+        return {}
+
+    # Exact device name if available, else truncated description
+    if "item_data.resource.deviceName" in findings.columns:
+        names = findings["item_data.resource.deviceName"].str[0].str.get("name")
+    else:
+        names = pd.Series(index=findings.index, dtype=object)
+    names = names.fillna(_col(findings, "description", "Unknown Device").str.slice(0, 50) + "...")
+
+    models = _col(findings, "item_data.resource.modelNumber", "N/A")
+    levels = _col(findings, "concern_level").str.upper()
+    bullets = "• " + names + " (Model: " + models + ") - " + levels + " risk"
+    return bullets.groupby(findings["mrn"]).agg("\n".join).to_dict()
+
+def parse_batch_to_df(data_list):
+    """Flattens the complex nested JSON payloads into the spreadsheet DataFrame in one vectorized pass."""
+    rows = pd.json_normalize(data_list, sep=".")
+    is_err = rows["error"].notna() if "error" in rows.columns else pd.Series(False, index=rows.index)
+
+    # Successful payloads: vectorized cleanup + list-joins instead of per-row dict walking
+    ok = rows[~is_err]
+    devices = _devices_by_mrn([d for d in data_list if "error" not in d])
+    out_ok = pd.DataFrame({
+        "MRN": _col(ok, "patient_info.mrn").str.replace("🏥 ", "", regex=False),  # Cleaning emojis if preferred
+        "Name": _col(ok, "patient_info.name").str.replace("👤 ", "", regex=False),
+        "DOB": _col(ok, "patient_info.dob").str.replace("📅 ", "", regex=False),
+        "Gender": _col(ok, "patient_info.gender").str.replace("⚧ ", "", regex=False),
+        "Safety Status": _col(ok, "mri_safety_assessment.status"),
+        "Risk Level": _col(ok, "mri_safety_assessment.risk"),
+        "Devices/Implants Found": _col(ok, "patient_info.mrn").map(devices).fillna(""),
+        "Clinical Summary": _col(ok, "mri_safety_assessment.summary"),
+        "Key Concerns": _col(ok, "mri_safety_assessment.concerns").str.join("\n"),
+        "Technologist Recommendations": _col(ok, "mri_safety_assessment.recommendations").str.join("\n"),
+        "Timestamp": _col(ok, "timestamp"),
+    })
+
+    # Error payloads keep the minimal MRN/Status/Summary shape
+    err = rows[is_err]
+    out_err = pd.DataFrame({
+        "MRN": _col(err, "patient_info.mrn", "Unknown"),
+        "Status": "API Error",
+        "Summary": _col(err, "error"),
+    })
+
+    return pd.concat([out_ok, out_err]).sort_index()
 
 # --- Streamlit UI ---
 st.set_page_config(page_title="MRI Safety Batch Processor", layout="wide")
@@ -92,40 +130,49 @@ if st.button("Analyze Patients"):
         
         # 2. Progress Bar
         progress_bar = st.progress(0)
-        results = []
-        
-        # 3. Loop and Fetch
-        for i, mrn in enumerate(mrn_list):
-            data = fetch_patient_data(mrn)
-            flat_row = parse_data_to_row(data)
-            results.append(flat_row)
-            progress_bar.progress((i + 1) / len(mrn_list))
-            
-        # 4. Create DataFrame
-        df = pd.DataFrame(results)
+
+        # 3. Fetch — try one coalesced POST first, else fall back to parallel per-MRN calls
+        batch = fetch_patient_data_batch(mrn_list)
+        if batch is not None:
+            datas = batch
+            progress_bar.progress(1.0)
+        else:
+            fetched = {}
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                futures = {executor.submit(fetch_patient_data, mrn): i for i, mrn in enumerate(mrn_list)}
+                for future in as_completed(futures):
+                    fetched[futures[future]] = future.result()
+                    progress_bar.progress(len(fetched) / len(mrn_list))
+            datas = [fetched[i] for i in range(len(mrn_list))]
+
+        # 4. Create DataFrame (vectorized flattening of all payloads at once)
+        df = parse_batch_to_df(datas)
         
         # 5. Display Preview
         st.success("Analysis Complete!")
         st.dataframe(df)
         
         # 6. Excel Download Logic
-        # We use BytesIO to create the file in memory
+        # We use BytesIO to create the file in memory (streamed row-by-row, constant memory)
         output = BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name='Safety Report')
-            
-            # Auto-adjust column widths (Optional polish)
+        with pd.ExcelWriter(output, engine='xlsxwriter',
+                            engine_kwargs={'options': {'constant_memory': True}}) as writer:
             workbook = writer.book
-            worksheet = writer.sheets['Safety Report']
+            worksheet = workbook.add_worksheet('Safety Report')
             text_wrap_format = workbook.add_format({'text_wrap': True, 'valign': 'top'})
-            
-            # Apply wrapping to long text columns
+
+            # Apply wrapping to long text columns (must be set before rows are flushed)
             for col_num, col_name in enumerate(df.columns):
                 if col_name in ["Devices/Implants Found", "Clinical Summary", "Key Concerns", "Technologist Recommendations"]:
                     worksheet.set_column(col_num, col_num, 50, text_wrap_format)
                 else:
                     worksheet.set_column(col_num, col_num, 20)
 
+            # write_row skips pandas' per-cell type dispatch and frees each row as it goes
+            worksheet.write_row(0, 0, df.columns)
+            for row_num, row in enumerate(df.fillna("").itertuples(index=False), start=1):
+                worksheet.write_row(row_num, 0, row)
+
         processed_data = output.getvalue()
 
         st.download_button(